@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+
+import argparse
+from datetime import datetime, timedelta
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import sqlalchemy
+from sqlalchemy import func, select
+
+import pylmstat
+
+# The phases of the scale benchmark, in the order they are run
+PHASE_LIST = [ 'create', 'insert', 'aggregate', 'analyse', 'analyse_days', 'analyse_year', 'export_tsv', 'export_json' ]
+
+
+def write_dump(f, features, checkouts):
+    """
+    Write a synthetic lmstat output with a number of features, each with a number of
+    licenses in use.
+    """
+    f.write("lmutil - Copyright (c) 1989-2011 Flexera Software, Inc. All Rights Reserved.\n")
+    f.write("Flexible License Manager status on Tue 2/24/2015 16:45\n\n")
+    f.write("Feature usage info:\n\n")
+    for feature in range(features):
+        f.write("Users of Feature_%04d:  (Total of %d licenses issued;  Total of %d licenses in use)\n\n" % (feature, checkouts + 10, checkouts))
+        f.write("  \"Feature_%04d\" v31, vendor: MLM\n  floating license\n\n" % feature)
+        for checkout in range(checkouts):
+            f.write("    user-%03d host-%03d /dev/pts/%d (v31) (lmstat.host.com/1712 %d), start Tue 2/24 %d:%02d\n" % (checkout, checkout, checkout % 10, 1000 + checkout, checkout % 24, checkout % 60))
+        f.write("\n")
+
+
+def bench_parse(features, checkouts):
+    """
+    Time the streaming parser over a synthetic lmstat output.
+    """
+    with tempfile.NamedTemporaryFile(suffix='.txt', delete=False) as f:
+        write_dump(f, features, checkouts)
+        dump_path = f.name
+
+    try:
+        t0 = time.time()
+        records = 0
+        with open(dump_path, 'r') as f:
+            for record in pylmstat.parse(f):
+                records += 1
+        elapsed = time.time() - t0
+        size = os.path.getsize(dump_path)
+    finally:
+        os.remove(dump_path)
+
+    print "parse: %d features, %d checkouts" % (features, features*checkouts)
+    print "  %d records in %.3f s (%.0f records/s, %.1f MB/s)" % (records, elapsed, records/elapsed, size/elapsed/1e6)
+    print "  peak RSS %.1f MB" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0)
+
+
+def write_status(f, dt, products, users):
+    """
+    Write a synthetic lmstat output at a time, with every user using every product.
+    """
+    f.append("Flexible License Manager status on %s %d/%d/%d %d:%02d\n" % (dt.strftime("%a"), dt.month, dt.day, dt.year, dt.hour, dt.minute))
+    f.append("Feature usage info:\n")
+    for product in products:
+        f.append("Users of %s:  (Total of %d licenses issued;  Total of %d licenses in use)\n" % (product, users + 10, users))
+        for user in range(users):
+            f.append("    user-%02d host-%02d /dev/pts/%d (v31) (lmstat.host.com/1712 %d), start %s %d/%d %d:%02d\n" % (user, user, user % 10, 1000 + user, dt.strftime("%a"), dt.month, dt.day, dt.hour, dt.minute))
+
+
+def count_samples(lmstat, products):
+    """
+    Return the number of raw samples of the products in the database.
+    """
+    if (lmstat.schema == 'normalized'):
+        return lmstat.engine.execute(select([ func.count() ]).select_from(pylmstat.Lmstats_Samples.__table__)).scalar()
+    return sum(lmstat.engine.execute(select([ func.count() ]).select_from(lmstat.Tables[product].__table__)).scalar() for product in products)
+
+
+def bench_scale(options):
+    """
+    Time each phase of building and analysing a synthetic database, returning a result per phase.
+    """
+    np.random.seed(options['seed'])
+    products = pylmstat.PRODUCT_LIST[:options['products']]
+    tmp_path = tempfile.mkdtemp()
+    try:
+        if (options['backend'] == 'memory'):
+            db_url = 'sqlite://'
+        else:
+            db_url = 'sqlite:///' + os.path.join(tmp_path, 'lmstat.db')
+        profiler = pylmstat.Profiler(enabled=True)
+        lmstat = pylmstat.Lmstat(db_url, source=options['source'], schema=options['schema'], profiler=profiler)
+
+        # Insert the polls just before the created history, so that they do not change the analysis
+        current_time = datetime.now()
+        insert_start = datetime(current_time.year, current_time.month, current_time.day) - timedelta(days=options['days'] + 1)
+
+        phases = [
+            ( 'create', lambda: lmstat.create(options['days'], interval=options['interval'], users=options['users'], products=products) ),
+            ( 'insert', lambda: [ lmstat.insert(lmstat_out) for lmstat_out in lmstat_outs ] ),
+            ( 'aggregate', lambda: lmstat.aggregate(products, jobs=options['jobs'], processes=(options['pool'] == 'process')) ),
+            ( 'analyse', lambda: lmstat.analyse(products) ),
+            ( 'analyse_days', lambda: lmstat.analyse_days(products) ),
+            ( 'analyse_year', lambda: lmstat.analyse_year(products) ),
+            ( 'export_tsv', lambda: lmstat.export(tmp_path, 'tsv', products) ),
+            ( 'export_json', lambda: lmstat.export(tmp_path, 'json', products) ) ]
+        results = [ ]
+        rows = 0
+        for (phase, run) in phases:
+            if (phase == 'aggregate') and (options['jobs'] is None):
+                continue
+            if (phase == 'insert'):
+                lmstat_outs = [ ]
+                for poll in range(options['inserts']):
+                    lmstat_out = [ ]
+                    write_status(lmstat_out, insert_start + timedelta(minutes=poll), products, options['users'])
+                    lmstat_outs.append(lmstat_out)
+            with profiler.phase(phase):
+                run()
+            # The phase is the last to finish, after any phases within it
+            elapsed = profiler.phases[-1]['wall']
+            statements = profiler.phases[-1]['queries']
+            if (phase in [ 'create', 'insert' ]):
+                # Ingest phases are measured by the rows written, the others by the rows they read
+                rows_before = rows
+                rows = count_samples(lmstat, products)
+                phase_rows = rows - rows_before
+            else:
+                phase_rows = rows
+            results.append(dict(options, phase=phase, wall=elapsed, rows=phase_rows, rows_per_s=phase_rows/elapsed if (elapsed > 0) else 0.0, queries=statements,
+                                query_time=profiler.phases[-1]['query_time'],
+                                peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0))
+    finally:
+        shutil.rmtree(tmp_path)
+
+    return results
+
+
+def isolated(function, *args):
+    """
+    Call a function in a fresh process and return its result. The process is not a daemon,
+    so the function can start a pool of its own.
+    """
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=lambda: results.put(function(*args)))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def run_scale(options):
+    """
+    Run the scale benchmark for each backend in a fresh process, so that peak RSS is not
+    carried over from one run to the next.
+    """
+    results = [ ]
+    for backend in [ 'memory', 'file' ]:
+        # Keep the fastest of the repeats of each phase, which is the least disturbed by other load
+        fastest = { }
+        for repeat in range(options['repeat']):
+            for result in isolated(bench_scale, dict(options, backend=backend)):
+                if (result['phase'] not in fastest) or (result['wall'] < fastest[result['phase']]['wall']):
+                    fastest[result['phase']] = result
+        results.extend(fastest[phase] for phase in PHASE_LIST if (phase in fastest))
+
+    print "scale: %(days)d days every %(interval)d min, %(products)d products, %(users)d users (%(source)s, %(schema)s)" % options
+    if (options['jobs'] is not None):
+        print "  aggregated by %(jobs)d %(pool)s workers" % options
+    print "  %-7s %-13s %9s %10s %12s %8s %9s" % ("backend", "phase", "wall (s)", "rows", "rows/s", "queries", "RSS (MB)")
+    for result in results:
+        print "  %(backend)-7s %(phase)-13s %(wall)9.3f %(rows)10d %(rows_per_s)12.0f %(queries)8d %(peak_rss_mb)9.1f" % result
+
+    return results
+
+
+def bench_startup(runs):
+    """
+    Time a cron poll (pylmstat.py -r -i) in a fresh interpreter, which is dominated by the
+    imports and the schema check, returning the median result.
+    """
+    script_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'pylmstat.py')
+    tmp_path = tempfile.mkdtemp()
+    try:
+        dump_path = os.path.join(tmp_path, 'lmstat.txt')
+        with open(dump_path, 'w') as f:
+            lmstat_out = [ ]
+            write_status(lmstat_out, datetime(2015, 2, 24, 16, 45), pylmstat.PRODUCT_LIST, 20)
+            f.writelines(lmstat_out)
+        db_url = 'sqlite:///' + os.path.join(tmp_path, 'lmstat.db')
+
+        # The first run creates the database, the rest insert into it
+        subprocess.check_call([ sys.executable, script_path, '-d', db_url, '-r', dump_path, '-i' ])
+        results = [ ]
+        for run in range(runs):
+            with open(dump_path, 'w') as f:
+                lmstat_out = [ ]
+                write_status(lmstat_out, datetime(2015, 2, 24, 16, 46) + timedelta(minutes=run), pylmstat.PRODUCT_LIST, 20)
+                f.writelines(lmstat_out)
+            cpu = resource.getrusage(resource.RUSAGE_CHILDREN)
+            t0 = time.time()
+            subprocess.check_call([ sys.executable, script_path, '-d', db_url, '-r', dump_path, '-i' ])
+            elapsed = time.time() - t0
+            cpu_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            results.append({ 'backend': 'file', 'phase': 'startup', 'wall': elapsed, 'cpu': (cpu_after.ru_utime - cpu.ru_utime) + (cpu_after.ru_stime - cpu.ru_stime),
+                             'rows': len(pylmstat.PRODUCT_LIST), 'queries': 0 })
+    finally:
+        shutil.rmtree(tmp_path)
+
+    # Check which of the analysis modules the collector imports
+    modules = subprocess.check_output([ sys.executable, '-c', "import sys; sys.argv = [ 'pylmstat.py' ]; sys.path.insert(0, %r); import pylmstat; "
+                                        "print ' '.join(sorted(set(module.split('.')[0] for module in sys.modules if module.split('.')[0] in [ 'numpy', 'matplotlib', 'sqlalchemy_utils' ])))"
+                                        % os.path.dirname(script_path) ]).split()
+
+    result = sorted(results, key=lambda result: result['wall'])[len(results)//2]
+    result['rows_per_s'] = result['rows']/result['wall']
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/1024.0
+    print "startup: median of %d polls of pylmstat.py -r -i" % runs
+    print "  %.3f s wall, %.3f s CPU, peak RSS %.1f MB" % (result['wall'], result['cpu'], result['peak_rss_mb'])
+    print "  analysis modules imported: %s" % (' '.join(modules) or "none")
+
+    return [ result ]
+
+
+def stress_collector(db_url, schema, threads, polls, products, users, results):
+    """
+    Write polls from several threads through the write queue of one collector, with every
+    thread writing the same datetimes, and new users appearing as the polls go on.
+    """
+    lmstat = pylmstat.Lmstat(db_url, schema=schema)
+    lmstat.queue_writes()
+    start = datetime(2000, 1, 1)
+    latencies = [ ]
+    errors = [ ]
+
+    def collect():
+        for poll in range(polls):
+            samples = [ ( product, users, [ "user-%02d" % (poll + user) for user in range(users) ] ) for product in products ]
+            t0 = time.time()
+            try:
+                lmstat.write(start + timedelta(minutes=poll), samples)
+            except Exception, e:
+                errors.append(str(e))
+            latencies.append(time.time() - t0)
+
+    t0 = time.time()
+    collectors = [ threading.Thread(target=collect) for thread in range(threads) ]
+    for collector in collectors:
+        collector.start()
+    for collector in collectors:
+        collector.join()
+    lmstat.writer.close()
+    results.put({ 'phase': 'stress_write', 'wall': time.time() - t0, 'rows': (len(latencies) - len(errors))*len(products), 'errors': len(errors),
+                  'max_latency': max(latencies), 'messages': errors[:5] })
+
+
+def stress_analyser(db_url, schema, products, export_path, stop, results):
+    """
+    Analyse and export the database over and over until stopped.
+    """
+    lmstat = pylmstat.Lmstat(db_url, schema=schema)
+    runs = 0
+    errors = [ ]
+    t0 = time.time()
+    while (runs == 0) or not stop.is_set():
+        try:
+            lmstat.reset(products)
+            lmstat.analyse(products)
+            lmstat.analyse_days(products)
+            lmstat.analyse_year(products)
+            lmstat.export(export_path, 'json', products)
+        except Exception, e:
+            errors.append(str(e))
+        runs += 1
+    results.put({ 'phase': 'stress_analyse', 'wall': time.time() - t0, 'runs': runs, 'errors': len(errors), 'messages': errors[:5] })
+
+
+def bench_stress(options):
+    """
+    Run collector processes, each writing from several threads, against analyser processes
+    on the same SQLite file in the given schema, and count the errors and the rows which
+    went missing.
+    """
+    np.random.seed(options['seed'])
+    products = pylmstat.PRODUCT_LIST[:options['products']]
+    tmp_path = tempfile.mkdtemp()
+    try:
+        db_url = 'sqlite:///' + os.path.join(tmp_path, 'lmstat.db')
+        lmstat = pylmstat.Lmstat(db_url, schema=options['schema'])
+        lmstat.create(options['days'], interval=options['interval'], users=options['users'], products=products)
+        rows = count_samples(lmstat, products)
+
+        results = multiprocessing.Queue()
+        stop = multiprocessing.Event()
+        collectors = [ multiprocessing.Process(target=stress_collector, args=(db_url, options['schema'], options['threads'], options['polls'], products, options['users'], results))
+                       for collector in range(options['collectors']) ]
+        analysers = [ multiprocessing.Process(target=stress_analyser, args=(db_url, options['schema'], products, tmp_path, stop, results)) for analyser in range(options['readers']) ]
+        for process in analysers + collectors:
+            process.start()
+        for process in collectors:
+            process.join()
+        stop.set()
+        for process in analysers:
+            process.join()
+        process_results = [ results.get() for process in collectors + analysers ]
+        missing = rows + options['collectors']*options['threads']*options['polls']*len(products) - count_samples(lmstat, products)
+    finally:
+        shutil.rmtree(tmp_path)
+
+    write_results = [ result for result in process_results if (result['phase'] == 'stress_write') ]
+    analyse_results = [ result for result in process_results if (result['phase'] == 'stress_analyse') ]
+    write = { 'backend': 'file', 'phase': 'stress_write', 'schema': options['schema'], 'wall': max(result['wall'] for result in write_results), 'rows': sum(result['rows'] for result in write_results),
+              'errors': sum(result['errors'] for result in write_results) + missing, 'missing': missing, 'max_latency': max(result['max_latency'] for result in write_results), 'queries': 0 }
+    write['rows_per_s'] = write['rows']/write['wall']
+    analyse = { 'backend': 'file', 'phase': 'stress_analyse', 'schema': options['schema'], 'wall': sum(result['wall'] for result in analyse_results)/sum(result['runs'] for result in analyse_results),
+                'runs': sum(result['runs'] for result in analyse_results), 'errors': sum(result['errors'] for result in analyse_results), 'queries': 0 }
+
+    print "stress: %(collectors)d collectors of %(threads)d threads writing %(polls)d polls, %(readers)d analysers (%(schema)s)" % options
+    print "  writes: %(rows)d rows in %(wall).3f s (%(rows_per_s).0f rows/s), maximum latency %(max_latency).3f s, %(errors)d errors, %(missing)d missing" % write
+    print "  analyses: %(runs)d runs of %(wall).3f s, %(errors)d errors" % analyse
+    for result in process_results:
+        for message in result['messages']:
+            print "  error: %s" % message
+
+    return [ write, analyse ]
+
+
+def compare(results, baseline_path, threshold):
+    """
+    Compare the results with a baseline, returning the phases which are slower by more than the
+    threshold fraction or which issue more queries.
+    """
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)
+    def key(result):
+        return tuple(result.get(name) for name in [ 'backend', 'phase', 'days', 'interval', 'products', 'users', 'source', 'schema', 'jobs', 'pool' ])
+    baseline_results = dict((key(result), result) for result in baseline['results'])
+
+    regressions = [ ]
+    for result in results:
+        base = baseline_results.get(key(result))
+        if (base is None):
+            continue
+        if (result['wall'] > base['wall']*(1.0 + threshold)) and (result['wall'] - base['wall'] > 0.01):
+            regressions.append("%s %s: %.3f s against %.3f s" % (result['backend'], result['phase'], result['wall'], base['wall']))
+        if (result.get('errors', 0) > base.get('errors', 0)):
+            regressions.append("%s %s: %d errors against %d" % (result['backend'], result['phase'], result['errors'], base.get('errors', 0)))
+        if (result['queries'] > base['queries']):
+            regressions.append("%s %s: %d queries against %d" % (result['backend'], result['phase'], result['queries'], base['queries']))
+
+    return regressions
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark the lmstat statistics collection.")
+    parser.add_argument('benchmarks', help="Benchmarks to run, of parse, scale, startup and stress [parse]", nargs='*')
+    parser.add_argument('--features', help="Number of features in the synthetic lmstat output [500]", default=500, type=int)
+    parser.add_argument('--checkouts', help="Number of licenses in use per feature [200]", default=200, type=int)
+    parser.add_argument('--days', help="Days of history in the synthetic database [100]", default=100, type=int)
+    parser.add_argument('--interval', help="Minutes between polls in the synthetic database [15]", default=15, type=int)
+    parser.add_argument('--products', help="Number of products in the synthetic database [%d]" % len(pylmstat.PRODUCT_LIST), default=len(pylmstat.PRODUCT_LIST), type=int)
+    parser.add_argument('--users', help="Number of users in the synthetic database [40]", default=40, type=int)
+    parser.add_argument('--inserts', help="Number of lmstat outputs to insert [100]", default=100, type=int)
+    parser.add_argument('--source', help="Source of the hourly aggregates [scan]", choices=pylmstat.SOURCE_LIST, default='scan')
+    parser.add_argument('--schema', help="Database schema [legacy]", choices=pylmstat.SCHEMA_LIST, default='legacy')
+    parser.add_argument('--jobs', help="Number of workers which aggregate before the analysis in the scale benchmark [none]", type=int)
+    parser.add_argument('--pool', help="Pool of the aggregating workers [process]", choices=[ 'process', 'thread' ], default='process')
+    parser.add_argument('--repeat', help="Number of times to run the scale benchmark, keeping the fastest [3]", default=3, type=int)
+    parser.add_argument('--runs', help="Number of polls to time in the startup benchmark [11]", default=11, type=int)
+    parser.add_argument('--collectors', help="Number of collector processes in the stress benchmark [2]", default=2, type=int)
+    parser.add_argument('--threads', help="Number of writing threads per collector in the stress benchmark [4]", default=4, type=int)
+    parser.add_argument('--polls', help="Number of polls written per thread in the stress benchmark [50]", default=50, type=int)
+    parser.add_argument('--readers', help="Number of analyser processes in the stress benchmark [3]", default=3, type=int)
+    parser.add_argument('--seed', help="Seed of the synthetic data [0]", default=0, type=int)
+    parser.add_argument('-o', '--output', help="Write the results to a JSON file")
+    parser.add_argument('--compare', help="Compare the results with a JSON file written by --output, failing on a regression")
+    parser.add_argument('--threshold', help="Fraction by which a phase may be slower than in the --compare file [0.2]", default=0.2, type=float)
+
+    args = parser.parse_args()
+    benchmarks = args.benchmarks or [ 'parse' ]
+    for benchmark in benchmarks:
+        if (benchmark not in [ 'parse', 'scale', 'startup', 'stress' ]):
+            parser.error("unknown benchmark %s" % benchmark)
+    if not (1 <= args.products <= len(pylmstat.PRODUCT_LIST)):
+        parser.error("--products must be between 1 and %d" % len(pylmstat.PRODUCT_LIST))
+
+    results = [ ]
+    if ('parse' in benchmarks):
+        bench_parse(args.features, args.checkouts)
+    if ('scale' in benchmarks):
+        options = dict((name, getattr(args, name)) for name in [ 'days', 'interval', 'products', 'users', 'inserts', 'source', 'schema', 'seed', 'repeat', 'jobs', 'pool' ])
+        results.extend(run_scale(options))
+    if ('stress' in benchmarks):
+        options = dict((name, getattr(args, name)) for name in [ 'days', 'interval', 'products', 'users', 'collectors', 'threads', 'polls', 'readers', 'seed' ])
+        # Each schema takes its own locks and ids, so stress both
+        for schema in pylmstat.SCHEMA_LIST:
+            options['schema'] = schema
+            results.extend(bench_stress(options))
+    if ('startup' in benchmarks):
+        results.extend(bench_startup(args.runs))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({ 'created': datetime.now().isoformat(), 'python': platform.python_version(), 'sqlalchemy': sqlalchemy.__version__, 'numpy': np.__version__,
+                        'results': results }, f, indent=1, sort_keys=True)
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        for regression in regressions:
+            print "regression: %s" % regression
+        if (len(regressions) > 0):
+            sys.exit(1)
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""
+A stand-in for lmutil which prints canned lmstat output, so that the collector can be run
+without a license server:
+
+./pylmstat.py -d 'sqlite:///lmstat.db' --daemon --lmutil ./fake_lmutil.py --server 27000@host1 --server 27000@host2 --interval 10 -v
+
+The number of licenses in use is random. Set FAKE_LMUTIL_DELAY to a number of seconds to
+simulate a slow server, or FAKE_LMUTIL_FAIL to simulate a server which is down.
+"""
+
+from datetime import datetime
+import os
+import random
+import sys
+import time
+
+# The features served, with the number of licenses issued
+FEATURES = [ ( 'MATLAB', 35 ), ( 'SIMULINK', 10 ), ( 'Image_Toolbox', 7 ), ( 'Optimization_Toolbox', 5 ), ( 'Signal_Toolbox', 5 ), ( 'Statistics_Toolbox', 5 ) ]
+USERS = [ "user-%02d" % _ for _ in range(40) ]
+
+
+def main():
+
+    # Usage: fake_lmutil.py lmstat -c <license file or port@host> -a
+    server = sys.argv[3] if (len(sys.argv) > 3) else "27000@lmstat.host.com"
+    host = server.split('@')[-1]
+
+    time.sleep(float(os.environ.get('FAKE_LMUTIL_DELAY', 0.0)))
+    if ('FAKE_LMUTIL_FAIL' in os.environ):
+        print "lmgrd is not running: License server machine is down or not responding. (-96,7:2 \"No such file or directory\")"
+        sys.exit(1)
+
+    now = datetime.now()
+    print "lmutil - Copyright (c) 1989-2011 Flexera Software, Inc. All Rights Reserved."
+    print "Flexible License Manager status on %s %d/%d/%d %d:%02d" % (now.strftime("%a"), now.month, now.day, now.year, now.hour, now.minute)
+    print
+    print "License server status: %s" % server
+    print
+    print "Feature usage info:"
+    print
+    handle = 1000
+    for (feature, issued) in FEATURES:
+        inuse = random.randint(0, issued)
+        print "Users of %s:  (Total of %d licenses issued;  Total of %d license%s in use)" % (feature, issued, inuse, "" if (inuse == 1) else "s")
+        print
+        if (inuse > 0):
+            print "  \"%s\" v31, vendor: MLM" % feature
+            print "  floating license"
+            print
+            for user in random.sample(USERS, inuse):
+                handle += 1
+                print "    %s %s-pc /dev/pts/%d (v31) (%s/27000 %d), start %s %d/%d %d:%02d" % (user, user, handle % 10, host, handle, now.strftime("%a"), now.month, now.day, now.hour, now.minute)
+            print
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+"""
+Regression tests of the analysis against the original per-hour implementation, which ran
+one query per product, day and hour:
+
+python -m unittest -v test_pylmstat
+"""
+
+from datetime import datetime, timedelta
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import numpy as np
+from sqlalchemy import func, select
+from sqlalchemy.orm import sessionmaker
+
+import pylmstat
+
+# The days analysed, which are fewer than DAY_RANGE so that the reference runs quickly
+DAY_RANGE = 10
+
+
+def reference_usage(lmstat, product, day_range):
+    """
+    Compute the usage of the product with the original per-hour loops of analyse(),
+    analyse_days() and analyse_year(), over day_range days up to today. The users are
+    left out, as their hours are now counted once per hour (see reference_user_hours()).
+    """
+    session = sessionmaker(bind=lmstat.engine)()
+    table = lmstat.Tables[product]
+    usage = { 'inuse_hour_max_max': [ 0 for _ in range(24) ], 'inuse_hour_avg_avg': [ 0 for _ in range(24) ], 'inuse_hour_avg_today': [ 0 for _ in range(24) ], 'users_hour_today': [ 0 for _ in range(24) ],
+              'datetime_day': [ ], 'inuse_hour_date_avg': [ ], 'users_hour_date': [ ], 'date_day': [ ], 'inuse_day_avg': [ ], 'users_day': [ ] }
+
+    current_time = datetime.now()
+    current_day = datetime(current_time.year, current_time.month, current_time.day)
+
+    def rows(start, end):
+        return session.query(table).filter(start <= table.datetime).filter(table.datetime < end).all()
+
+    def distinct_users(rs):
+        users = [ ]
+        for row in rs:
+            if len(row.users):
+                for user in row.users.split(','):
+                    if (user not in users):
+                        users.append(user)
+        return users
+
+    # analyse()
+    for hour in range(24):
+        inuse_hour_avg_tot = 0
+        for dayspast in range(day_range):
+            dayhourstart = current_day - timedelta(days=dayspast) + timedelta(hours=hour)
+            rs = rows(dayhourstart, dayhourstart + timedelta(hours=1))
+            inuse_day_hour_tot = 0
+            for row in rs:
+                inuse_day_hour_tot += row.inuse
+                usage['inuse_hour_max_max'][hour] = max(usage['inuse_hour_max_max'][hour], row.inuse)
+            if (dayspast == 0):
+                if (len(rs) > 0):
+                    usage['inuse_hour_avg_today'][hour] = inuse_day_hour_tot/float(len(rs))
+                usage['users_hour_today'][hour] = ', '.join(distinct_users(rs))
+            if (len(rs) > 0):
+                inuse_hour_avg_tot += inuse_day_hour_tot/float(len(rs))
+        usage['inuse_hour_avg_avg'][hour] = inuse_hour_avg_tot/float(day_range)
+
+    # analyse_days()
+    for dayspast in range(day_range):
+        usage['datetime_day'].append([ "" for _ in range(24) ])
+        usage['inuse_hour_date_avg'].append([ 0.0 for _ in range(24) ])
+        usage['users_hour_date'].append([ "" for _ in range(24) ])
+        for hour in range(24):
+            dayhourstart = current_day - timedelta(days=dayspast) + timedelta(hours=hour)
+            rs = rows(dayhourstart, dayhourstart + timedelta(hours=1))
+            usage['datetime_day'][dayspast][hour] = dayhourstart.strftime("%Y-%m-%d")
+            if (len(rs) > 0):
+                usage['inuse_hour_date_avg'][dayspast][hour] = sum(row.inuse for row in rs)/float(len(rs))
+            usage['users_hour_date'][dayspast][hour] = ', '.join(distinct_users(rs))
+
+    # analyse_year()
+    for dayspast in range(day_range):
+        daystart = current_day - timedelta(days=dayspast)
+        rs = rows(daystart, daystart + timedelta(days=1))
+        if (len(rs) > 0):
+            usage['date_day'].append(daystart.strftime("%Y-%m-%d"))
+            usage['inuse_day_avg'].append(sum(row.inuse for row in rs)/float(len(rs)))
+            usage['users_day'].append(', '.join(distinct_users(rs)))
+
+    session.close()
+    return usage
+
+def reference_user_hours(lmstat, product, day_range):
+    """
+    Count the hours over day_range days up to today in which each user of the product held
+    a license.
+    """
+    session = sessionmaker(bind=lmstat.engine)()
+    table = lmstat.Tables[product]
+    current_time = datetime.now()
+    start = datetime(current_time.year, current_time.month, current_time.day) - timedelta(days=day_range - 1)
+
+    hours = { }
+    for row in session.query(table).filter(start <= table.datetime).filter(table.datetime < start + timedelta(days=day_range)).all():
+        for user in (row.users.split(',') if row.users else [ ]):
+            hours.setdefault(user, set()).add(row.datetime.replace(minute=0, second=0, microsecond=0))
+    session.close()
+    return dict((user, len(user_hours)) for (user, user_hours) in hours.items())
+
+
+class AnalysisTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.db_url = 'sqlite:///' + os.path.join(cls.tmpdir, 'lmstat.db')
+        np.random.seed(0)
+        pylmstat.Lmstat(cls.db_url).create(DAY_RANGE + 2)
+        cls.reference = { }
+        cls.user_hours = { }
+        lmstat = pylmstat.Lmstat(cls.db_url)
+        for product in [ 'MATLAB', 'SIMULINK' ]:
+            cls.reference[product] = reference_usage(lmstat, product, DAY_RANGE)
+            cls.user_hours[product] = reference_user_hours(lmstat, product, DAY_RANGE)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def analysed(self, source):
+        lmstat = pylmstat.Lmstat(self.db_url, source=source)
+        lmstat.day_range = DAY_RANGE
+        lmstat.analyse()
+        lmstat.analyse_days()
+        lmstat.analyse_year()
+        return lmstat
+
+    def assertUsageEqual(self, usage, reference):
+        for (key, expected) in reference.items():
+            actual = usage[key]
+            if key.startswith('inuse'):
+                np.testing.assert_allclose(np.array(actual, dtype=float), np.array(expected, dtype=float), err_msg=key)
+            else:
+                self.assertEqual(actual, expected, key)
+
+    def assertUserHoursEqual(self, usage, product):
+        self.assertEqual(usage['users'], self.user_hours[product])
+
+    def test_scan(self):
+        lmstat = self.analysed('scan')
+        for product in self.reference:
+            self.assertUsageEqual(lmstat.Usage[product], self.reference[product])
+            self.assertUserHoursEqual(lmstat.Usage[product], product)
+
+    def test_sql(self):
+        lmstat = self.analysed('sql')
+        for product in self.reference:
+            self.assertUsageEqual(lmstat.Usage[product], self.reference[product])
+            self.assertUserHoursEqual(lmstat.Usage[product], product)
+
+    def test_rollup(self):
+        lmstat = self.analysed('rollup')
+        for product in self.reference:
+            self.assertUsageEqual(lmstat.Usage[product], self.reference[product])
+            self.assertUserHoursEqual(lmstat.Usage[product], product)
+
+class MigrateTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.db_url = 'sqlite:///' + os.path.join(cls.tmpdir, 'lmstat.db')
+        np.random.seed(1)
+        pylmstat.Lmstat(cls.db_url).create(DAY_RANGE + 2)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def counts(self):
+        lmstat = pylmstat.Lmstat(self.db_url)
+        return dict((product, lmstat.engine.execute(select([ func.count() ]).select_from(lmstat.Tables[product].__table__)).scalar()) for product in pylmstat.PRODUCT_LIST)
+
+    def analysed(self, schema):
+        lmstat = pylmstat.Lmstat(self.db_url, schema=schema)
+        lmstat.day_range = DAY_RANGE
+        lmstat.analyse()
+        lmstat.analyse_days()
+        lmstat.analyse_year()
+        return lmstat
+
+    def test_migrate(self):
+        counts = self.counts()
+        # A legacy instance migrates into the normalized tables and keeps its own
+        pylmstat.Lmstat(self.db_url).migrate()
+        self.assertEqual(self.counts(), counts)
+
+        legacy = self.analysed('legacy')
+        normalized = self.analysed('normalized')
+        for product in pylmstat.PRODUCT_LIST:
+            for (key, expected) in legacy.Usage[product].items():
+                actual = normalized.Usage[product][key]
+                if key.startswith('inuse'):
+                    np.testing.assert_allclose(np.array(actual, dtype=float), np.array(expected, dtype=float), err_msg=key)
+                elif key.startswith('users_'):
+                    # The normalized schema orders the users of a sample by id rather than as polled
+                    sort = lambda users: sorted(users.split(', ')) if isinstance(users, basestring) else [ sort(item) for item in users ]
+                    self.assertEqual(sort(actual), sort(expected), key)
+                else:
+                    self.assertEqual(actual, expected, key)
+
+class StartupTest(unittest.TestCase):
+
+    # The modules of the analysis, which a cron poll should not import
+    ANALYSIS_MODULES = [ 'numpy', 'matplotlib', 'sqlalchemy_utils' ]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_poll(self):
+        script_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'pylmstat.py')
+        input_path = os.path.join(self.tmpdir, 'lmstat.txt')
+        with open(input_path, 'w') as f:
+            f.write(subprocess.check_output([ sys.executable, os.path.join(os.path.dirname(script_path), 'fake_lmutil.py') ]))
+        db_path = os.path.join(self.tmpdir, 'lmstat.db')
+
+        # Run pylmstat.py -r -i as a script in a fresh interpreter, then list the analysis modules it imported
+        code = ("import runpy, sys; sys.argv = [ %r, '-d', %r, '-r', %r, '-i' ]\n"
+                "try:\n    runpy.run_path(sys.argv[0], run_name='__main__')\n"
+                "finally:\n    print ' '.join(sorted(set(module.split('.')[0] for module in sys.modules) & set(%r)))") % (script_path, 'sqlite:///' + db_path, input_path, self.ANALYSIS_MODULES)
+        t0 = time.time()
+        output = subprocess.check_output([ sys.executable, '-c', code ])
+        elapsed = time.time() - t0
+
+        self.assertEqual(output.split('\n')[-2].split(), [ ])
+        # One row per product in the output, which would take well under a second without the analysis imports
+        (_, dt, samples, _) = pylmstat.parse_file(input_path)
+        connection = sqlite3.connect(db_path)
+        rows = sum(connection.execute('SELECT COUNT(*) FROM "Lmstats_%s"' % product).fetchone()[0] for product in pylmstat.PRODUCT_LIST)
+        connection.close()
+        self.assertEqual(rows, len(samples))
+        self.assertLess(elapsed, 10.0)
+
+class TrackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.lmstat = pylmstat.Lmstat('sqlite:///' + os.path.join(self.tmpdir, 'lmstat.db'), store=( 'samples', 'sessions' ))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def open_sessions(self):
+        sessions = pylmstat.Lmstats_Sessions
+        return sorted(server for (server, ) in self.lmstat.engine.execute(select([ sessions.server ]).where(sessions.end == None)))
+
+    def test_failed_server(self):
+        fake_lmutil = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fake_lmutil.py')
+        commands = [ [ sys.executable, fake_lmutil, 'lmstat', '-c', '27000@%s' % server, '-a' ] for server in [ 'a.host', 'b.host' ] ]
+        checkouts = [ ]
+        servers = [ ]
+        samples = self.lmstat.poll(commands, 10.0, checkouts, servers=servers)
+        self.assertEqual(sorted(servers), [ ( 'a.host', 27000 ), ( 'b.host', 27000 ) ])
+        self.lmstat.write(datetime.now(), samples, checkouts, servers=servers)
+        self.assertEqual(sorted(set(self.open_sessions())), [ 'a.host', 'b.host' ])
+        opened = len([ checkout for checkout in checkouts if (checkout.server == 'b.host') ])
+
+        # The second server fails, while the first serves the same products without checkouts
+        checkouts = [ ]
+        servers = [ ]
+        samples = self.lmstat.poll([ commands[0], [ sys.executable, '-c', 'import sys; sys.exit(1)' ] ], 10.0, checkouts, servers=servers)
+        self.assertEqual(servers, [ ( 'a.host', 27000 ) ])
+        self.lmstat.write(datetime.now(), [ ( product, 0, [ ] ) for (product, inuse, users) in samples ], [ ], servers=servers)
+        self.assertEqual(self.open_sessions(), [ 'b.host' ]*opened)
+
+        # Without the servers polled, every session which was not seen has ended
+        self.lmstat.write(datetime.now(), [ ( product, 0, [ ] ) for (product, inuse, users) in samples ], [ ])
+        self.assertEqual(self.open_sessions(), [ ])
+
+if __name__ == '__main__':
+
+    unittest.main()